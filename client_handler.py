@@ -1,5 +1,6 @@
 import time 
 import util
+from scheduler import Scheduler
 import traceback
 import slackclient 
 from pprint import pprint
@@ -8,6 +9,19 @@ import traceback
 import ujson as json
 import socket
 import websocket
+import random
+from collections import OrderedDict
+
+
+CONNECTION_ERRORS = (socket.error,
+        websocket._exceptions.WebSocketConnectionClosedException,
+        slackclient.server.SlackConnectionError)
+RECONNECT_BASE_DELAY = 0.25
+RECONNECT_MAX_DELAY = 30
+SEEN_EVENTS_SIZE = 1000
+# seconds to wait before refetching history that failed without a
+# Retry-After header
+HISTORY_RETRY_DELAY = 5
 
 
 def make_uid2name(data):
@@ -32,9 +46,15 @@ def response_is_message(r):
             if r['text']:
                 return True
     return False
-            
 
 
+def event_id(r):
+    '''
+    Something that identifies a message event, so we can tell when we've
+    already seen it, e.g. when catching up on history after a reconnect.
+    '''
+    return r.get('client_msg_id') or (r['channel'], r.get('ts'))
+
 
 class ClientHandler(object):
     '''
@@ -52,6 +72,14 @@ class ClientHandler(object):
             ( user, message, True )
         which will send those messages to those channels or users.
 
+        The brain can also implement
+            brain.channels()
+        returning the names of the channels it cares about, so only those get
+        caught up on after a reconnect, and
+            brain.schedule_tasks(scheduler)
+        to register periodic callbacks on a scheduler.Scheduler, whose replies
+        get sent the same way.
+
         name is used to differentiate log files, ideally this should match with
         the bot's name but it's not mandatory.
         '''
@@ -65,6 +93,14 @@ class ClientHandler(object):
         self.error_logger.addHandler(error_hdlr)
         self.queued_messages = []
         self.last_message_time = time.time()-1
+        # channel id -> ts of the last message we handled there, used to fetch
+        # whatever we missed while disconnected
+        self.last_seen_ts = {}
+        self.seen_events = OrderedDict()
+        # channels whose history we couldn't fetch; their last_seen_ts stays
+        # put until a retry fills the gap
+        self.history_gaps = set()
+        self.next_gap_retry = 0
 
         if log_text:
             self.text_logger = logging.getLogger('text_logger')
@@ -75,6 +111,9 @@ class ClientHandler(object):
             self.text_logger = False
 
         self.brain = brain
+        self.scheduler = Scheduler(on_error=self._log_job_error)
+        if self.brain_implements('schedule_tasks'):
+            self.brain.schedule_tasks(self.scheduler)
 
     def brain_implements(self, method_name):
         method = getattr(self.brain, method_name, None)
@@ -86,8 +125,10 @@ class ClientHandler(object):
         main loop.
         '''
         key_okay = False
+        self.scheduler.start()
         while True:
             self.sc = slackclient.SlackClient(self.token)
+            connected_at = time.time()
             if not self.sc.rtm_connect():
                 errmsg = 'Couldn\'t establish a connection! '
                 if not key_okay:
@@ -100,16 +141,129 @@ class ClientHandler(object):
                     continue
             key_okay = True
             self.initialize()
+            # on a fresh start this only seeds the channels; if reconnect()
+            # gave up it picks up whatever was said while we were down
+            self.seed_last_seen(connected_at)
+            self.catch_up()
             while True:
                 try:
                     self.main_loop_handler()
-                    time.sleep(0.1)
-                except (socket.error, websocket._exceptions.WebSocketConnectionClosedException, slackclient.server.SlackConnectionError) as e:
+                    # rtm_read doesn't block, so we still tick, but a
+                    # scheduled job's replies wake us up right away
+                    self.scheduler.wait_for_replies(0.1)
+                except CONNECTION_ERRORS as e:
                     print(e)
-                    print('Lost connection, trying to reconnect in 10 seconds...')
-                    time.sleep(10)
-                    del self.sc
-                    break
+                    print('Lost connection, reconnecting...')
+                    if not self.reconnect(time.time()):
+                        del self.sc
+                        break
+
+    def reconnect(self, disconnected_at, max_attempts=10):
+        '''
+        Reconnects the rtm websocket on the existing client, with exponential
+        backoff and jitter between attempts. The user/channel dictionaries and
+        the outbound queue are kept, and anything said since disconnected_at
+        in channels the bot is in is fetched from history. Returns False if we
+        gave up, in which case run() starts over from scratch.
+        '''
+        for attempt in range(max_attempts):
+            delay = min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2**attempt)
+            time.sleep(random.uniform(0, delay))
+            try:
+                if not self.sc.rtm_connect(with_team_state=False):
+                    continue
+                self.seed_last_seen(disconnected_at)
+                self.catch_up()
+                self.send_messages([])
+                return True
+            except CONNECTION_ERRORS as e:
+                print(e)
+        return False
+
+    def seed_last_seen(self, ts):
+        '''
+        Starts tracking every channel the bot is in (and the brain cares
+        about) that we haven't seen a message in yet, from time ts, so
+        catch_up covers those too.
+        '''
+        for channel in self._member_channels():
+            self.last_seen_ts.setdefault(channel, '%.6f' % ts)
+
+    def _member_channels(self):
+        '''
+        Returns the ids of the channels the bot is a member of, limited to
+        brain.channels() if the brain has it. DMs are left out.
+        '''
+        wanted = None
+        if self.brain_implements('channels'):
+            wanted = set(self.brain.channels())
+        out = []
+        cursor = None
+        while True:
+            kwargs = {'types': 'public_channel,private_channel',
+                      'exclude_archived': True, 'limit': 200}
+            if cursor:
+                kwargs['cursor'] = cursor
+            j = self.sc.api_call('users.conversations', **kwargs)
+            if not j.get('ok'):
+                print('Couldn\'t list channels: %s' % j.get('error'))
+                break
+            out += [c['id'] for c in j.get('channels', [])
+                    if wanted is None or c.get('name') in wanted]
+            cursor = j.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                break
+        return out
+
+    def catch_up(self, channels=None):
+        '''
+        Fetches messages newer than the last one we saw in each tracked
+        channel (or just channels) and runs them through the brain like they
+        came in over rtm. Channels whose history we couldn't get are left in
+        self.history_gaps for main_loop_handler to retry.
+        '''
+        if channels is None:
+            channels = list(self.last_seen_ts)
+        messages_to_send = []
+        for channel in channels:
+            history, retry_after = self._history_since(
+                    channel, self.last_seen_ts[channel])
+            if history is None:
+                self.history_gaps.add(channel)
+                self.next_gap_retry = max(self.next_gap_retry,
+                        time.time() + retry_after)
+                continue
+            self.history_gaps.discard(channel)
+            for r in history:
+                r.setdefault('channel', channel)
+                if response_is_message(r):
+                    messages_to_send += self._handle_response(r)
+        self.send_messages(messages_to_send)
+
+    def _history_since(self, channel, oldest):
+        '''
+        Returns (messages in channel after the timestamp oldest, oldest
+        first, None). If slack won't give us all of them, e.g. because we're
+        rate limited, returns (None, seconds to wait before trying again)
+        instead, since a partial history would leave a hole.
+        '''
+        out = []
+        cursor = None
+        while True:
+            kwargs = {'channel': channel, 'oldest': oldest, 'limit': 200}
+            if cursor:
+                kwargs['cursor'] = cursor
+            j = self.sc.api_call('conversations.history', **kwargs)
+            if not j.get('ok'):
+                print('Couldn\'t fetch history for %s: %s' % (
+                    channel, j.get('error')))
+                retry_after = j.get('headers', {}).get('Retry-After')
+                return None, float(retry_after or HISTORY_RETRY_DELAY)
+            out += j.get('messages', [])
+            cursor = j.get('response_metadata', {}).get('next_cursor')
+            if not j.get('has_more') or not cursor:
+                break
+        return sorted(out, key=lambda r: float(r['ts'])), None
 
     def log_error(self, message='', dm=True):
         '''
@@ -126,6 +280,13 @@ class ClientHandler(object):
             self.send_dm('ocharles', u'%s\n```%s```' % (message,errorstring))
         self.error_logger.error(errorstring)
 
+    def _log_job_error(self):
+        '''
+        Logs a scheduled job that raised. Runs on the scheduler's thread, so
+        it doesn't try to dm anyone over the rtm connection.
+        '''
+        self.log_error(dm=False)
+
     def user_to_dm_channel(self, user):
         '''
         Tries to figure out the channel ID of the dm channel for user.
@@ -189,13 +350,18 @@ class ClientHandler(object):
         if now  - self.last_message_time >= 1:
             self.queued_messages = util.compress_messages(self.queued_messages)
             if self.queued_messages:
-                for channel, message in self.queued_messages:
+                # anything we couldn't send because the connection dropped
+                # stays queued until reconnect() flushes it
+                while self.queued_messages:
+                    channel, message = self.queued_messages[0]
                     try:
                         self.sc.rtm_send_message(channel, message)
+                    except CONNECTION_ERRORS:
+                        raise
                     except:
                         self.log_error()
+                    self.queued_messages.pop(0)
                 self.last_message_time = now
-                self.queued_messages = []
 
 
     def _filter_replies(self, replies):
@@ -236,9 +402,32 @@ class ClientHandler(object):
             if 'type' not in r or r['type'] != 'message':
                 continue
             if response_is_message(r):
-                messages_to_send += self._filter_replies(self.response_handler(r))
+                messages_to_send += self._handle_response(r)
         messages_to_send += self._filter_replies(self.non_response_handler())
+        messages_to_send += self._filter_replies(self.scheduler.pop_replies())
         self.send_messages(messages_to_send)
+        if self.history_gaps and time.time() >= self.next_gap_retry:
+            self.catch_up(list(self.history_gaps))
+
+    def _handle_response(self, r):
+        '''
+        Passes a message along to the brain unless we've handled it already,
+        and remembers where we are in its channel.
+        '''
+        eid = event_id(r)
+        if eid in self.seen_events:
+            return []
+        self.seen_events[eid] = True
+        if len(self.seen_events) > SEEN_EVENTS_SIZE:
+            self.seen_events.popitem(last=False)
+        channel = r['channel']
+        # untracked channels aren't caught up on, and gapped ones have to keep
+        # their old ts until the missing history is fetched
+        if ('ts' in r and channel in self.last_seen_ts and
+                channel not in self.history_gaps):
+            if float(r['ts']) > float(self.last_seen_ts[channel]):
+                self.last_seen_ts[channel] = r['ts']
+        return self._filter_replies(self.response_handler(r))
 
     def _replace_userid_with_name(self, word):
         '''
@@ -4,11 +4,22 @@ from bs4 import BeautifulSoup
 import requests as re
 import os
 import random
+import time
+import hmac
+import hashlib
+import threading
 
 in_dev = 0
 BASE_URL = 'https://projecteuler.net/problem='
 PROD_CHANNEL = 'projecteuler'
 DEV_CHANNEL = 'bottest'
+PROBLEM_OF_THE_DAY_CRON = '0 9 * * 1-5'
+# contest mode: each user gets CONTEST_BURST answers, refilled at
+# CONTEST_RATE answers per second, and solves are written to disk every
+# CONTEST_FLUSH_INTERVAL seconds
+CONTEST_BURST = 5
+CONTEST_RATE = 0.5
+CONTEST_FLUSH_INTERVAL = 30
 if in_dev:
     channel = DEV_CHANNEL
 else:
@@ -26,7 +37,11 @@ class EulerBot(object):
             'unsolve problem': self.mark_unsolved,
             'go to problem': self.go_to_problem,
             'show solved': self.show_solved,
-            'random between': self.random_unsolved_problem
+            'random between': self.random_unsolved_problem,
+            'contest start': self.start_contest,
+            'contest stop': self.stop_contest,
+            'contest problem': self.set_contest_problem,
+            'contest scores': self.show_contest_scores
         }
 
         self.CHANNEL = channel
@@ -36,6 +51,9 @@ class EulerBot(object):
             os.getcwd(), 'eulerbot', 'progress.json')
         with open(self.PROGRESS_FILE, 'r') as f:
             self.progress = json.load(f)
+        # scheduled tasks run on the scheduler's thread, so anything touching
+        # self.progress or the progress file has to hold this
+        self.progress_lock = threading.Lock()
 
         self.current_problem = self.progress["current_problem"]
 
@@ -43,6 +61,17 @@ class EulerBot(object):
             os.getcwd(), 'eulerbot', 'solution.txt')
         self.answers = self._get_answers()
 
+        self.in_contest = False
+        self.answer_salt = os.urandom(16)
+        self.answer_hashes = {}
+        self.contest_problems = {}
+        self.contest_scores = {}
+        self.submission_tokens = {}
+        self.pending_solved = []
+        # only guards pending_solved, so contest replies never wait on
+        # flush_progress writing the progress file
+        self.pending_lock = threading.Lock()
+
     def _get_answers(self):
         """Handling the loading of answers from file"""
         answers = {}
@@ -57,21 +86,26 @@ class EulerBot(object):
         return answers
 
     def update_current_problem(self, new_problem):
-        self.current_problem = new_problem
-        self.progress["current_problem"] = new_problem
-        with open(self.PROGRESS_FILE, 'w') as f:
-            json.dump(self.progress, f)
+        with self.progress_lock:
+            self.current_problem = new_problem
+            self.progress["current_problem"] = new_problem
+            with open(self.PROGRESS_FILE, 'w') as f:
+                json.dump(self.progress, f)
+
+    def _problem_message(self, problem):
+        """Fetch the statement of the specified problem number"""
+        url = BASE_URL + problem
+        r = re.get(url)
+        soup = BeautifulSoup(r.text)
+        problem_content = soup.find('div', {'class': 'problem_content'})
+        return "Project Euler problem #" + \
+            problem + " " + \
+            problem_content.text + " \n From url: " + url
 
     def show_problem(self, problem):
         """Display the statement of the specified problem number"""
         try:
-            url = BASE_URL + problem
-            r = re.get(url)
-            soup = BeautifulSoup(r.text)
-            problem_content = soup.find('div', {'class': 'problem_content'})
-            message = "Project Euler problem #" + \
-                problem + " " + \
-                problem_content.text + " \n From url: " + url
+            message = self._problem_message(problem)
             self.update_current_problem(problem)
             return message
         except Exception as e:
@@ -88,7 +122,9 @@ class EulerBot(object):
             return [(channel, message)]
         else:
             random_problem = random.randint(beginning, end)
-            while str(random_problem) in self.progress["solved"]:
+            with self.progress_lock:
+                solved = set(self.progress["solved"])
+            while str(random_problem) in solved:
                 random_problem += 1
             message = self.show_problem(str(random_problem))
             return[(channel, message)]
@@ -108,13 +144,17 @@ class EulerBot(object):
 
     def next_unsolved_problem(self, user, channel, message):
         """Go to the next unsolved problem. Update current problem #"""
-        solved = self.progress["solved"]
+        message = self.show_problem(self._first_unsolved_problem())
+        return [(channel, message)]
+
+    def _first_unsolved_problem(self):
+        with self.progress_lock:
+            solved = set(self.progress["solved"])
         print(solved)
         current_problem = 1
         while str(current_problem) in solved:
             current_problem += 1
-        message = self.show_problem(str(current_problem))
-        return [(channel, message)]
+        return str(current_problem)
 
     def go_to_problem(self, user, channel, message):
         """Go to the specified problem"""
@@ -139,9 +179,13 @@ class EulerBot(object):
     def check_answer(self, user, channel, message):
         """Check answer and mark as solved if correct"""
         ans = message[len("eulerbot check answer "):]
+        if self.in_contest:
+            return self._check_contest_answer(user, channel, ans)
         problem = self.progress["current_problem"]
 
-        if self.answers[problem] == ans:
+        if problem not in self.answers:
+            message = "I don't know the answer to problem #" + str(problem)
+        elif self.answers[problem] == ans:
             message = "Congrats, " + user + ", you solved " +\
                       "problem #" + str(problem)
             self.mark_solved(problem)
@@ -149,19 +193,104 @@ class EulerBot(object):
             message = "Nah, try again!"
         return [(channel, message)]
 
+    def _hash_answer(self, ans):
+        return hashlib.sha256(self.answer_salt + ans.strip().encode()).digest()
+
+    def _allow_submission(self, user):
+        """Token bucket rate limit on contest answers, per user"""
+        now = time.time()
+        tokens, last = self.submission_tokens.get(user, (CONTEST_BURST, now))
+        tokens = min(CONTEST_BURST, tokens + (now - last) * CONTEST_RATE)
+        if tokens < 1:
+            self.submission_tokens[user] = (tokens, now)
+            return False
+        self.submission_tokens[user] = (tokens - 1, now)
+        return True
+
+    def _check_contest_answer(self, user, channel, ans):
+        """Check an answer against the user's own contest problem. Solves
+        are kept in memory until the next flush_progress"""
+        if not self._allow_submission(user):
+            return [(channel, "Slow down, " + user + "!")]
+        problem = self.contest_problems.get(user, self.current_problem)
+        expected = self.answer_hashes.get(problem)
+        if expected is None:
+            message = "I don't know the answer to problem #" + str(problem)
+        elif hmac.compare_digest(expected, self._hash_answer(ans)):
+            solved = self.contest_scores.setdefault(user, set())
+            if problem not in solved:
+                solved.add(problem)
+                with self.pending_lock:
+                    self.pending_solved.append(problem)
+            message = "Congrats, " + user + ", you solved " +\
+                      "problem #" + str(problem)
+        else:
+            message = "Nah, try again!"
+        return [(channel, message)]
+
+    def start_contest(self, user, channel, message):
+        """Start contest mode, hashing all the answers up front"""
+        self.answer_hashes = {problem: self._hash_answer(ans)
+                              for problem, ans in self.answers.items()}
+        self.contest_problems = {}
+        self.contest_scores = {}
+        self.submission_tokens = {}
+        self.in_contest = True
+        message = "Contest started! Pick a problem with " +\
+                  "'eulerbot contest problem <number>', or answer " +\
+                  "problem #" + str(self.current_problem)
+        return [(channel, message)]
+
+    def stop_contest(self, user, channel, message):
+        """End contest mode and save everything that was solved"""
+        self.in_contest = False
+        self.flush_progress()
+        return self.show_contest_scores(user, channel, message)
+
+    def set_contest_problem(self, user, channel, message):
+        """Set the problem the user's contest answers are checked against"""
+        problem = message[len("eulerbot contest problem "):].strip()
+        self.contest_problems[user] = problem
+        return [(channel, user + " is on problem #" + problem)]
+
+    def show_contest_scores(self, user, channel, message):
+        scores = sorted(self.contest_scores.items(),
+                        key=lambda x: len(x[1]), reverse=True)
+        if not scores:
+            return [(channel, "Nobody has solved anything yet")]
+        message = "\n".join(name + ": " + str(len(solved))
+                            for name, solved in scores)
+        return [(channel, message)]
+
+    def flush_progress(self):
+        """Write solves batched up during a contest to the progress file"""
+        with self.pending_lock:
+            pending, self.pending_solved = self.pending_solved, []
+        if not pending:
+            return []
+        with self.progress_lock:
+            for problem in pending:
+                if problem not in self.progress["solved"]:
+                    self.progress["solved"].append(problem)
+            with open(self.PROGRESS_FILE, 'w') as f:
+                json.dump(self.progress, f)
+        return []
+
     def mark_solved(self, problem):
         """Mark problem as solved"""
-        self.progress["solved"].append(problem)
-        with open(self.PROGRESS_FILE, 'w') as f:
-            json.dump(self.progress, f)
+        with self.progress_lock:
+            self.progress["solved"].append(problem)
+            with open(self.PROGRESS_FILE, 'w') as f:
+                json.dump(self.progress, f)
 
     def mark_solved_command(self, user, channel, message):
         """"Mark the problem specified in the message as solved"""
         problem = message[len("eulerbot mark as solved problem "):]
         self.mark_solved(problem)
+        with self.progress_lock:
+            solved = str(self.progress["solved"])
         message = "Marked problem #" + str(problem) + \
-                  " as solved. Solved problems are: " + \
-                  str(self.progress["solved"])
+                  " as solved. Solved problems are: " + solved
         return [(channel, message)]
 
     def mark_unsolved(self, user, channel, message):
@@ -169,23 +298,43 @@ class EulerBot(object):
         problem = message[len("eulerbot unsolve problem "):]
         # extract the question number
 
-        try:
-            self.progress["solved"].remove(problem)
-        except ValueError:
-            message = "Problem #"+str(problem)+" not yet solved. " +\
-                "Solved problems are: " + \
-                str(self.progress["solved"])
-            return[(channel, message)]
+        with self.progress_lock:
+            try:
+                self.progress["solved"].remove(problem)
+            except ValueError:
+                message = "Problem #"+str(problem)+" not yet solved. " +\
+                    "Solved problems are: " + \
+                    str(self.progress["solved"])
+                return[(channel, message)]
 
-        with open(self.PROGRESS_FILE, 'w') as f:
-            json.dump(self.progress, f)
+            with open(self.PROGRESS_FILE, 'w') as f:
+                json.dump(self.progress, f)
+            solved = str(self.progress["solved"])
         message = "Marked problem #" + str(problem) + \
-                  " as unsolved. Solved problems are: " + \
-                  str(self.progress["solved"])
+                  " as unsolved. Solved problems are: " + solved
         return [(channel, message)]
 
     def show_solved(self, user, channel, message):
-        return [(channel, str(self.progress["solved"]))]
+        with self.progress_lock:
+            return [(channel, str(self.progress["solved"]))]
+
+    def channels(self):
+        """Channels the client handler should catch up on after a
+        reconnect"""
+        return [self.CHANNEL]
+
+    def schedule_tasks(self, scheduler):
+        """Register periodic tasks with the client handler's scheduler"""
+        scheduler.cron(PROBLEM_OF_THE_DAY_CRON, self.post_problem_of_the_day)
+        scheduler.every(CONTEST_FLUSH_INTERVAL, self.flush_progress)
+
+    def post_problem_of_the_day(self):
+        """Post the next unsolved problem to the channel. This runs on the
+        scheduler's thread, so it leaves the current problem alone; errors
+        go to the client handler's error log"""
+        problem = self._first_unsolved_problem()
+        message = "Problem of the day! " + self._problem_message(problem)
+        return [(self.CHANNEL, message)]
 
     def handle_message(self, user, channel, message):
         """This is the main function that handles
@@ -0,0 +1,205 @@
+import time
+import heapq
+import datetime
+import itertools
+import threading
+import traceback
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+CRON_FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 6)]
+# how far ahead CronTrigger looks for a match before giving up; weekdays
+# repeat on a 28 year cycle, so e.g. a Feb 29 on a Monday is found in time
+CRON_SEARCH_DAYS = 28*366
+
+
+def parse_cron_field(field, lo, hi):
+    '''
+    Turns one field of a cron expression, e.g. "*", "5", "1-5", "*/15",
+    "5/15" or "0,30", into the set of values it matches.
+    '''
+    out = set()
+    for part in field.split(','):
+        step = None
+        if '/' in part:
+            part, step = part.split('/')
+            step = int(step)
+            if step < 1:
+                raise ValueError('Bad cron field %s' % field)
+        if part == '*':
+            start, end = lo, hi
+        elif '-' in part:
+            start, end = map(int, part.split('-'))
+        elif step:
+            start, end = int(part), hi
+        else:
+            start = end = int(part)
+        if start < lo or end > hi or start > end:
+            raise ValueError('Bad cron field %s' % field)
+        out.update(range(start, end+1, step or 1))
+    return out
+
+
+class CronTrigger(object):
+    '''
+    Fires on a standard 5 field cron expression
+        minute hour day-of-month month day-of-week
+    with day-of-week 0 being Sunday, in local time. As in cron, if both
+    day-of-month and day-of-week are restricted (don't start with "*") a day
+    matches if either of them does.
+    '''
+    def __init__(self, expr):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError('Cron expressions need 5 fields, got %s' % expr)
+        self.minutes, self.hours, self.days, self.months, self.weekdays = [
+                parse_cron_field(f, lo, hi)
+                for f, (lo, hi) in zip(fields, CRON_FIELDS)]
+        self.either_day = not (fields[2].startswith('*') or
+                               fields[4].startswith('*'))
+
+    def _day_matches(self, dt):
+        if dt.month not in self.months:
+            return False
+        day_ok = dt.day in self.days
+        weekday_ok = (dt.weekday() + 1) % 7 in self.weekdays
+        if self.either_day:
+            return day_ok or weekday_ok
+        return day_ok and weekday_ok
+
+    def next_time(self, now):
+        dt = datetime.datetime.fromtimestamp(now).replace(second=0,
+                microsecond=0) + datetime.timedelta(minutes=1)
+        limit = dt + datetime.timedelta(days=CRON_SEARCH_DAYS)
+        # skip whole days and hours that can't match so this stays cheap
+        while dt < limit:
+            if not self._day_matches(dt):
+                dt = (dt + datetime.timedelta(days=1)).replace(hour=0, minute=0)
+            elif dt.hour not in self.hours:
+                dt = (dt + datetime.timedelta(hours=1)).replace(minute=0)
+            elif dt.minute not in self.minutes:
+                dt += datetime.timedelta(minutes=1)
+            else:
+                return time.mktime(dt.timetuple())
+        raise ValueError('Cron expression never fires')
+
+
+class IntervalTrigger(object):
+    '''
+    Fires every `seconds` seconds.
+    '''
+    def __init__(self, seconds):
+        if seconds <= 0:
+            raise ValueError('Interval must be positive')
+        self.seconds = seconds
+
+    def next_time(self, now):
+        return now + self.seconds
+
+
+class Scheduler(object):
+    '''
+    Runs callbacks on interval or cron triggers. Jobs are kept in a heap by
+    deadline and a worker thread sleeps until the earliest one is due, so
+    nothing has to poll for it and slow callbacks don't hold up message
+    handling. Callbacks take no arguments and return a list of replies in the
+    same form as brain.handle_message; ClientHandler waits on wait_for_replies()
+    between ticks and picks them up with pop_replies(). Callbacks run on the
+    scheduler's thread, so anything they share with the message handling code
+    needs a lock.
+
+    on_error is called from inside the except block when a callback raises,
+    so it can use traceback.format_exc().
+    '''
+    def __init__(self, on_error=None):
+        self.jobs = []
+        self.counter = itertools.count()
+        self.cv = threading.Condition()
+        self.replies = queue.Queue()
+        self.has_replies = threading.Event()
+        self.on_error = on_error
+        self.thread = None
+
+    def every(self, seconds, callback):
+        return self.add(IntervalTrigger(seconds), callback)
+
+    def cron(self, expr, callback):
+        return self.add(CronTrigger(expr), callback)
+
+    def add(self, trigger, callback):
+        '''
+        Schedules callback on trigger, anything with a next_time(now) method.
+        Returns a job id that can be passed to cancel().
+        '''
+        job_id = next(self.counter)
+        with self.cv:
+            heapq.heappush(self.jobs,
+                    (trigger.next_time(time.time()), job_id, trigger, callback))
+            self.cv.notify()
+        return job_id
+
+    def cancel(self, job_id):
+        with self.cv:
+            self.jobs = [j for j in self.jobs if j[1] != job_id]
+            heapq.heapify(self.jobs)
+            self.cv.notify()
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def wait_for_replies(self, timeout):
+        '''
+        Blocks until a callback has produced replies or timeout seconds pass.
+        '''
+        return self.has_replies.wait(timeout)
+
+    def pop_replies(self):
+        '''
+        Returns all the replies produced by callbacks since the last call.
+        '''
+        self.has_replies.clear()
+        out = []
+        while True:
+            try:
+                out += self.replies.get_nowait()
+            except queue.Empty:
+                return out
+
+    def _next_due(self):
+        '''
+        Blocks until a job is due, pops it, and pushes it back with its next
+        deadline.
+        '''
+        with self.cv:
+            while True:
+                if not self.jobs:
+                    self.cv.wait()
+                    continue
+                now = time.time()
+                deadline, job_id, trigger, callback = self.jobs[0]
+                if deadline > now:
+                    self.cv.wait(deadline - now)
+                    continue
+                heapq.heapreplace(self.jobs,
+                        (trigger.next_time(now), job_id, trigger, callback))
+                return callback
+
+    def _run(self):
+        while True:
+            callback = self._next_due()
+            try:
+                replies = callback()
+                if replies:
+                    self.replies.put(list(replies))
+                    self.has_replies.set()
+            except:
+                if self.on_error:
+                    self.on_error()
+                else:
+                    traceback.print_exc()
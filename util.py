@@ -5,6 +5,11 @@ import string
 from slackclient import SlackClient
 import unicodedata, re
 import datetime
+import os
+import mmap
+import marshal
+import struct
+import hashlib
 
 all_chars = (chr(i) for i in range(0x110000))
 control_chars = ''.join(map(chr, list(range(0,32)) + list(range(127,160))))
@@ -55,32 +60,150 @@ def is_sublist(sublst, lst):
     n = len(sublst)
     return any((sublst == lst[i:i+n]) for i in range(len(lst)-n+1))
 
-def read_resource_dict():
-    # Resource dictionary
-    base_fn = 'locus_data/Resource Dictionary (Live) - '
-    fns = [base_fn + ending for ending in ['A.csv', 'B.csv', 'C.csv', 'D.csv', 'E.csv']]
-    r_dict = {}
+SNAPSHOT_MAGIC = b'EBSNAP2\n'
+# mtime_ns and size of each source csv are packed after the magic, followed
+# by a sha1 over all of the sources, a sha1 of the payload, and the payload,
+# which is the dictionary marshalled. marshal only does plain data, so a
+# tampered snapshot can't run code the way a pickle could.
+SNAPSHOT_HEADER = struct.Struct('<I20s20s')
+SNAPSHOT_STAT = struct.Struct('<qq')
+
+def _stat_key(fns):
+    out = []
+    for fn in fns:
+        st = os.stat(fn)
+        out.append((st.st_mtime_ns, st.st_size))
+    return out
+
+def _hash_files(fns):
+    h = hashlib.sha1()
     for fn in fns:
         with open(fn, 'rb') as f:
-            reader = csv.reader(f)
-            reader.next()
-            for row in reader:
-                name = row[0]
-                locus = '%s %s %s' % (row[1], row[2], row[3])
-                if name not in r_dict.keys():
-                    r_dict[name] = {'answer': locus}
-                else:
-                    print(name, locus, r_dict[name])
-                    exit()
-    return r_dict
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                h.update(chunk)
+    return h.digest()
 
-def read_analyst_dict():
-    # Analyst dictionary
-    ad = {}
-    with open('locus_data/Analyst Dictionary.csv','rb') as f:
+def _snapshot_fn(fns, name):
+    return os.path.join(os.path.dirname(fns[0]), '.snapshots', name + '.snap')
+
+def _read_snapshot(snap_fn, fns, stats):
+    '''
+    Memory-maps a snapshot written by _write_snapshot and returns a tuple
+    (dictionary, whether the stored mtimes matched stats). The dictionary is
+    None if the snapshot is missing, corrupt, or doesn't match fns anymore.
+    The mtimes are checked first so the csvs only get hashed when they've
+    been touched.
+    '''
+    try:
+        f = open(snap_fn, 'rb')
+    except IOError:
+        return None, False
+    with f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return None, False
+        with mm:
+            try:
+                return _parse_snapshot(mm, fns, stats)
+            except (struct.error, ValueError, EOFError, TypeError):
+                return None, False
+
+def _parse_snapshot(mm, fns, stats):
+    offset = len(SNAPSHOT_MAGIC)
+    if mm[:offset] != SNAPSHOT_MAGIC:
+        return None, False
+    nfiles, digest, payload_digest = SNAPSHOT_HEADER.unpack_from(mm, offset)
+    offset += SNAPSHOT_HEADER.size
+    if nfiles != len(fns):
+        return None, False
+    stored = [SNAPSHOT_STAT.unpack_from(mm, offset + i*SNAPSHOT_STAT.size)
+            for i in range(nfiles)]
+    offset += nfiles * SNAPSHOT_STAT.size
+    stats_ok = stored == stats
+    if not stats_ok and digest != _hash_files(fns):
+        return None, False
+    view = memoryview(mm)
+    try:
+        payload = view[offset:]
+        if hashlib.sha1(payload).digest() != payload_digest:
+            return None, False
+        d = marshal.loads(payload)
+    finally:
+        view.release()
+    if not isinstance(d, dict):
+        return None, False
+    return d, stats_ok
+
+def _write_snapshot(snap_fn, stats, digest, d):
+    payload = marshal.dumps(d)
+    dirname = os.path.dirname(snap_fn)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    tmp_fn = snap_fn + '.tmp'
+    with open(tmp_fn, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(SNAPSHOT_HEADER.pack(len(stats), digest,
+                hashlib.sha1(payload).digest()))
+        for mtime, size in stats:
+            f.write(SNAPSHOT_STAT.pack(mtime, size))
+        f.write(payload)
+    os.replace(tmp_fn, snap_fn)
+
+def load_csv_dict(fns, name, build):
+    '''
+    Returns the dictionary build(fns) would make, but keeps a binary snapshot
+    of it next to the csvs so we only parse them again when they change.
+    build should take the list of filenames and return a dict of plain
+    strings/dicts.
+    '''
+    snap_fn = _snapshot_fn(fns, name)
+    # stat and hash before parsing, so a csv rewritten mid-parse leaves a
+    # snapshot keyed to the old contents and gets rebuilt next time
+    stats = _stat_key(fns)
+    d, stats_ok = _read_snapshot(snap_fn, fns, stats)
+    if stats_ok:
+        return d
+    digest = _hash_files(fns)
+    if d is None:
+        d = build(fns)
+    try:
+        _write_snapshot(snap_fn, stats, digest, d)
+    except (IOError, OSError):
+        print('Couldn\'t write snapshot %s' % snap_fn)
+    return d
+
+def iter_csv_rows(fn):
+    '''
+    Streams the rows of a csv file, skipping the header row.
+    '''
+    with open(fn, newline='') as f:
         reader = csv.reader(f)
-        reader.next()
+        next(reader, None)
         for row in reader:
+            yield row
+
+RESOURCE_DICT_FNS = ['locus_data/Resource Dictionary (Live) - ' + ending
+        for ending in ['A.csv', 'B.csv', 'C.csv', 'D.csv', 'E.csv']]
+ANALYST_DICT_FNS = ['locus_data/Analyst Dictionary.csv']
+
+def _build_resource_dict(fns):
+    r_dict = {}
+    for fn in fns:
+        for row in iter_csv_rows(fn):
+            name = row[0]
+            locus = '%s %s %s' % (row[1], row[2], row[3])
+            if name not in r_dict:
+                r_dict[name] = {'answer': locus}
+            else:
+                print(name, locus, r_dict[name])
+                exit()
+    return r_dict
+
+def _build_analyst_dict(fns):
+    ad = {}
+    for fn in fns:
+        for row in iter_csv_rows(fn):
             adid = str(row[0])
             title = row[1]
             desc = row[2]
@@ -90,22 +213,33 @@ def read_analyst_dict():
                     , 'adid': adid}
     return ad
 
-def read_analyst_dict_1():
-    # Analyst dictionary
+def _build_analyst_dict_1(fns):
     ad = {}
-    with open('locus_data/Analyst Dictionary.csv','rb') as f:
-        reader = csv.reader(f)
-        reader.next()
-        for row in reader:
+    for fn in fns:
+        for row in iter_csv_rows(fn):
             adid = str(row[0])
             title = row[1]
-            desc = row[2]
             el = row[11].strip()
             ad[adid] = {'title': title
                     , 'el': el
                     }
     return ad
 
+def read_resource_dict():
+    # Resource dictionary
+    return load_csv_dict(RESOURCE_DICT_FNS, 'resource_dict',
+            _build_resource_dict)
+
+def read_analyst_dict():
+    # Analyst dictionary
+    return load_csv_dict(ANALYST_DICT_FNS, 'analyst_dict',
+            _build_analyst_dict)
+
+def read_analyst_dict_1():
+    # Analyst dictionary, keyed by id
+    return load_csv_dict(ANALYST_DICT_FNS, 'analyst_dict_1',
+            _build_analyst_dict_1)
+
 def create_id2user(api_call):
     users = api_call['members']
     out = {}